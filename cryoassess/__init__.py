@@ -41,6 +41,7 @@ class Plugin(pwem.Plugin):
     _pathVars = [CRYOASSESS_MODELS]
     _url = "https://github.com/scipion-em/scipion-em-cryoassess"
     _supportedVersions = VERSIONS
+    _activationCmd = None
 
     @classmethod
     def _defineVariables(cls):
@@ -49,11 +50,14 @@ class Plugin(pwem.Plugin):
 
     @classmethod
     def getCryoAssessEnvActivation(cls):
-        """ Remove the scipion home and activate the conda environment. """
-        activation = cls.getVar(CRYOASSESS_ENV_ACTIVATION)
-        scipionHome = Config.SCIPION_HOME + os.path.sep
-
-        return activation.replace(scipionHome, "", 1)
+        """ Remove the scipion home and activate the conda environment.
+        The result is memoized, as it is needed for every program call. """
+        if cls._activationCmd is None:
+            activation = cls.getVar(CRYOASSESS_ENV_ACTIVATION)
+            scipionHome = Config.SCIPION_HOME + os.path.sep
+            cls._activationCmd = activation.replace(scipionHome, "", 1)
+
+        return cls._activationCmd
 
     @classmethod
     def getActiveVersion(cls, *args):
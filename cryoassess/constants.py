@@ -30,7 +30,7 @@ def getCryoAssessEnvName(version):
 
 
 V1_0_0 = "1.0.0"
-VERSIONS = [V1_0_0]
+VERSIONS = (V1_0_0,)
 CRYOASSESS_DEFAULT_VER_NUM = V1_0_0
 
 DEFAULT_ENV_NAME = getCryoAssessEnvName(CRYOASSESS_DEFAULT_VER_NUM)
@@ -24,8 +24,7 @@
 # *
 # **************************************************************************
 
-from glob import glob
-import re
+import os
 
 from pyworkflow.constants import PROD
 import pyworkflow.protocol.params as params
@@ -48,7 +47,6 @@ class CryoassessProt2D(ProtProcessParticles):
         'outputClasses': SetOfClasses2D,
         'outputClasses_discarded': SetOfClasses2D
     }
-    outputDict = {}
 
     def __init__(self, **kwargs):
         ProtProcessParticles.__init__(self, **kwargs)
@@ -56,13 +54,13 @@ class CryoassessProt2D(ProtProcessParticles):
     def _createFilenameTemplates(self):
         """ Centralize how files are called. """
         myDict = {'input_cls': self._getExtraPath('input_classes.mrcs')}
-        self._pathTemplate = self._getExtraPath('2DAssess/*/particle_*.jpg')
-        self._goodClassesRegex = re.compile(r'Good/particle_(\d*)\.jpg')
-        self._regex = re.compile(r'particle_(\d*)\.jpg')
+        self._outputDir = self._getExtraPath('2DAssess')
+        self._goodDir = os.path.join(self._outputDir, 'Good')
         self.goodList = []
         self.badList = []
 
         self._updateFilenamesDict(myDict)
+        self._inputClsFn = self._getFileName('input_cls')
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -88,11 +86,12 @@ class CryoassessProt2D(ProtProcessParticles):
     # --------------------------- STEPS functions -----------------------------
     def convertInputStep(self):
         """ Create a mrcs stack as expected by cryoassess and
-        store a list of objIds."""
+        map each objId to its 1-based position in the stack."""
         imgSet = self.inputRefs.get()
-        imgSet.writeStack(self._getFileName('input_cls'))
+        imgSet.writeStack(self._inputClsFn)
 
-        self.clsIds = list(self.inputRefs.get().getIdSet())
+        self.clsIdToPos = {oid: i + 1 for i, oid in
+                           enumerate(imgSet.getIdSet())}
 
     def run2DAssessStep(self):
         """ Call cryoassess with the appropriate parameters. """
@@ -101,50 +100,57 @@ class CryoassessProt2D(ProtProcessParticles):
         self.runJob(program, params, env=Plugin.getEnviron())
 
     def createOutputStep(self):
+        # Search through output files and find good and bad classes
+        self._getReferences()
+        if not (self.goodList or self.badList):
+            return
+
         inputRefs = self.inputRefs.get()
-        if self._getRefsType() == REF_CLASSES:
-            outRefs = SetOfClasses2D.create(self._getPath())
-            outBadRefs = SetOfClasses2D.create(self._getPath(),
-                                               suffix=DISCARDED)
-        else:
-            outRefs = self._createSetOfAverages()
-            outBadRefs = self._createSetOfAverages(suffix=DISCARDED)
+        refsType = self._getRefsType()
 
-        outRefs.copyInfo(inputRefs)
-        outBadRefs.copyInfo(inputRefs)
+        # Translate stack positions back to objIds once, so the
+        # filtering callbacks only test item ids against a set
+        self._goodIds = frozenset(oid for oid, pos in self.clsIdToPos.items()
+                                  if pos in self.goodList)
+        self._badIds = frozenset(oid for oid, pos in self.clsIdToPos.items()
+                                 if pos in self.badList)
 
-        # Search through output files and find good and bad classes
-        self._getReferences()
         if len(self.goodList):
-            if self._getRefsType() == REF_CLASSES:
+            if refsType == REF_CLASSES:
+                outRefs = SetOfClasses2D.create(self._getPath())
+            else:
+                outRefs = self._createSetOfAverages()
+            outRefs.copyInfo(inputRefs)
+            if refsType == REF_CLASSES:
                 outRefs.setObjLabel('good 2D classes')
                 outRefs.appendFromClasses(inputRefs,
                                           filterClassFunc=self._addGoodClass)
-                self.outputDict['outputClasses'] = outRefs
+                self._defineOutputs(outputClasses=outRefs)
+                self._defineSourceRelation(self.inputRefs, outRefs)
             else:
                 outRefs.setObjLabel('good class averages')
                 outRefs.copyItems(inputRefs,
                                   updateItemCallback=self._addGoodAvg)
-                self.outputDict['outputAverages'] = outRefs
+                self._defineOutputs(outputAverages=outRefs)
 
         if len(self.badList):
-            if self._getRefsType() == REF_CLASSES:
+            if refsType == REF_CLASSES:
+                outBadRefs = SetOfClasses2D.create(self._getPath(),
+                                                   suffix=DISCARDED)
+            else:
+                outBadRefs = self._createSetOfAverages(suffix=DISCARDED)
+            outBadRefs.copyInfo(inputRefs)
+            if refsType == REF_CLASSES:
                 outBadRefs.setObjLabel('bad 2D classes')
                 outBadRefs.appendFromClasses(inputRefs,
                                              filterClassFunc=self._addBadClass)
-                self.outputDict['outputClasses_discarded'] = outBadRefs
+                self._defineOutputs(outputClasses_discarded=outBadRefs)
+                self._defineSourceRelation(self.inputRefs, outBadRefs)
             else:
                 outBadRefs.setObjLabel('bad class averages')
                 outBadRefs.copyItems(inputRefs,
                                      updateItemCallback=self._addBadAvg)
-                self.outputDict['outputAverages_discarded'] = outBadRefs
-
-        self._defineOutputs(**self.outputDict)
-        if self._getRefsType() == REF_CLASSES:
-            if len(self.goodList):
-                self._defineSourceRelation(self.inputRefs, outRefs)
-            if len(self.badList):
-                self._defineSourceRelation(self.inputRefs, outBadRefs)
+                self._defineOutputs(outputAverages_discarded=outBadRefs)
 
     # --------------------------- INFO functions ------------------------------
     def _summary(self):
@@ -159,40 +165,49 @@ class CryoassessProt2D(ProtProcessParticles):
     # --------------------------- UTILS functions -----------------------------
     def _getArgs(self):
         """ Return the list of args for the command. """
-        args = ['-i %s ' % self._getFileName('input_cls'),
+        args = ['-i %s ' % self._inputClsFn,
                 '-m %s/2dassess_062119.h5' % Plugin.getVar(CRYOASSESS_MODELS),
                 '-b %d' % self.batchSize.get()]
 
         return args
 
     def _getReferences(self):
-        """ Return the list of good and bad classes files. """
-        files = sorted(glob(self._pathTemplate))
-        for i in files:
-            s = self._goodClassesRegex.search(i)
-            if s:
-                self.goodList.append(int(s.group(1)))
+        """ Populate the lists of good and bad class ids. Filenames
+        have a fixed particle_%d.jpg form, so the id can be sliced out
+        directly without any regex matching. """
+        if not os.path.isdir(self._outputDir):
+            return
+
+        goodList, badList = [], []
+        for d in os.scandir(self._outputDir):
+            if not d.is_dir():
+                continue
+            ids = [int(e.name[9:-4]) for e in os.scandir(d.path)
+                   if e.name.startswith('particle_')]
+            if d.name == 'Good':
+                goodList.extend(ids)
             else:
-                s = self._regex.search(i)
-                self.badList.append(int(s.group(1)))
+                badList.extend(ids)
+        self.goodList = frozenset(goodList)
+        self.badList = frozenset(badList)
 
     def _addGoodAvg(self, item, row):
         """ Callback function to append only good items. """
-        if self.clsIds.index(item.getObjId()) + 1 not in self.goodList:
+        if item.getObjId() not in self._goodIds:
             setattr(item, "_appendItem", False)
 
     def _addBadAvg(self, item, row):
         """ Callback function to append only bad items. """
-        if self.clsIds.index(item.getObjId()) + 1 not in self.badList:
+        if item.getObjId() not in self._badIds:
             setattr(item, "_appendItem", False)
 
     def _addGoodClass(self, item):
         """ Callback function to append only good classes. """
-        return False if self.clsIds.index(item.getObjId()) + 1 not in self.goodList else True
+        return item.getObjId() in self._goodIds
 
     def _addBadClass(self, item):
         """ Callback function to append only bad classes. """
-        return False if self.clsIds.index(item.getObjId()) + 1 not in self.badList else True
+        return item.getObjId() in self._badIds
 
     def _getRefsType(self):
         imgSet = self.inputRefs.get()
@@ -25,14 +25,13 @@
 # **************************************************************************
 
 import os
-import math
+import threading
 from enum import Enum
-from emtable import Table
 
 from pyworkflow.constants import PROD
 import pyworkflow.protocol.constants as pwcts
 from pyworkflow.protocol import params, STATUS_NEW, Protocol
-from pyworkflow.utils.path import copyTree
+from pyworkflow.utils.path import makePath
 from pwem.protocols import ProtPreprocessMicrographs
 from pwem.objects import SetOfMicrographs
 
@@ -51,10 +50,19 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
     _label = 'assess micrographs'
     _devStatus = PROD
     _possibleOutputs = outputs
+    # known camera aspect ratios (long side / short side)
+    _RATIO_TABLE = ((1.0345, 'K2'), (1.4076, 'K3'))
 
     def __init__(self, **kwargs):
         ProtPreprocessMicrographs.__init__(self, **kwargs)
         self.stepsExecutionMode = pwcts.STEPS_PARALLEL
+        # protects the cumulative star files and output sets, which are
+        # shared between concurrently running passes
+        self._outputLock = threading.Lock()
+        self._cameraType = None
+        self._cameraTypeDone = False
+        self._inputMicsCache = None
+        self._starHandles = {}
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -103,7 +111,7 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
             closeStep = self._getFirstJoinStep()
             newMics = self._getNewInput()
             if len(newMics) >= self._getStreamingBatchSize():
-                self.addDoneMicFns(newMics)
+                self.addDoneMics(newMics)
                 numPass = self.asPass
                 self.asPass += 1
                 newDeps = self._insertNewMicsSteps(newMics, numPass)
@@ -127,7 +135,14 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
     def initializeStep(self):
         """ Creates all the final output directories where
         each batch will be appended. """
-        self.doneMicFns = set([])
+        self.lastMicId = 0
+        self._goodMicsByPass = {}
+        self._absByObjId = {}
+        self._realByObjId = {}
+        self._cwd = os.getcwd()
+        self._parentFinished = False
+        self._lastMicsMTime = 0
+        self._pendingMics = []
         self.lastRound = False
         self.ended = False
         self.asPass = 1
@@ -136,41 +151,73 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
 
     def convertInputStep(self, newMics, numPass):
         """ Create a star file as expected by cryoassess."""
-        micsTable = Table(columns=['rlnMicrographName'])
+        micNames = []
+        seenReal = set()
         for mic in newMics:
-            micsTable.addRow(os.path.abspath(mic.getFileName()))
+            micName = self._absPath(mic.getFileName())
+            real = os.path.realpath(micName)
+            self._absByObjId[mic.getObjId()] = micName
+            self._realByObjId[mic.getObjId()] = real
+            # classify each physical file only once; duplicates
+            # (e.g. symlinked subsets) inherit the verdict later
+            if real not in seenReal:
+                seenReal.add(real)
+                micNames.append(micName)
+        star = ("# Star file generated with Scipion\n\n"
+                "data_\n\nloop_\n_rlnMicrographName \n" +
+                ''.join(' ' + micName + '\n' for micName in micNames))
         with open(self.getInputFilename(numPass), 'w') as f:
-            f.write("# Star file generated with Scipion\n")
-            micsTable.writeStar(f, tableName='')
-        self.appendTotalInputStar(numPass)
+            f.write(star)
+        self.appendTotalInputStar(micNames)
 
     def runMicAssessStep(self, numPass):
         """ Call cryoassess with the appropriate parameters. """
         params = ' '.join(self._getArgs(numPass))
         program = Plugin.getProgram('micassess')
-        self.runJob(program, params, env=Plugin.getEnviron(),
+        env = Plugin.getEnviron()
+        # let host-side preprocessing inside micassess use the
+        # requested number of threads
+        nThreads = str(self.numberOfThreads.get())
+        env.update({'OMP_NUM_THREADS': nThreads,
+                    'TF_NUM_INTRAOP_THREADS': nThreads,
+                    'TF_NUM_INTEROP_THREADS': nThreads})
+        self.runJob(program, params, env=env,
                     cwd=self._getTmpPath(), numberOfThreads=1)
-        self.appendTotalOutputStar(numPass)
+        goodMicNames = self._getGoodMicFns(numPass)
+        self._goodMicsByPass[numPass] = goodMicNames
+        self.appendTotalOutputStar(goodMicNames)
         self.copyMicAssessOutput(numPass)
 
     def createOutputStep(self, newMics, numPass):
-        outputName = "outputMicrographs"
-        outMics = self._loadOutputSet(SetOfMicrographs, outputName + '.sqlite')
-
-        # Parse output file and find good mics
-        goodMicNames = self._getGoodMicFns(numPass)
-        if len(goodMicNames):
-            self.curGoodList = goodMicNames
-            outMics.copyItems(newMics, updateItemCallback=self._addGoodMic)
-            self._updateOutputSet(outputName, outMics)
+        with self._outputLock:
+            # Good mics were already parsed by the run step; fall back
+            # to the star file on a restart
+            goodMicNames = self._goodMicsByPass.pop(numPass, None)
+            if goodMicNames is None:
+                goodMicNames = self._getGoodMicFns(numPass)
+
+            self._curGoodIds = self._getGoodIds(newMics, goodMicNames)
+
+            if len(self._curGoodIds):
+                outputName = "outputMicrographs"
+                outMics = self._loadOutputSet(SetOfMicrographs, outputName + '.sqlite')
+                if len(self._curGoodIds) == len(newMics):
+                    # every mic passed - skip the per-item callback
+                    outMics.copyItems(newMics)
+                else:
+                    outMics.copyItems(newMics, updateItemCallback=self._addGoodMic)
+                self._updateOutputSet(outputName, outMics)
 
-        if len(newMics) > len(goodMicNames):
-            outputDiscardedName = "discardedMicrographs"
-            outDiscMics = self._loadOutputSet(SetOfMicrographs, outputDiscardedName + '.sqlite')
-            outDiscMics.copyItems(newMics, updateItemCallback=self._addBadMic)
-            self._updateOutputSet(outputDiscardedName, outDiscMics)
+            if len(newMics) > len(self._curGoodIds):
+                outputDiscardedName = "discardedMicrographs"
+                outDiscMics = self._loadOutputSet(SetOfMicrographs, outputDiscardedName + '.sqlite')
+                outDiscMics.copyItems(newMics, updateItemCallback=self._addBadMic)
+                self._updateOutputSet(outputDiscardedName, outDiscMics)
 
     def closeSetStep(self):
+        for fh in self._starHandles.values():
+            fh.close()
+        self._starHandles.clear()
         self._closeOutputSet()
         if hasattr(self, 'outputMicrographs'):
             self._defineSourceRelation(self._getInputMicrographs(), self.outputMicrographs)
@@ -195,7 +242,15 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
         return goodMics
 
     def copyMicAssessOutput(self, numPass):
-        copyTree(self._getTmpPath('output%s' % numPass), self._getExtraPath('MicAssess'))
+        """ Move this pass output into the final MicAssess dir. Files are
+        renamed rather than copied, as tmp and extra share a filesystem. """
+        srcDir = self._getTmpPath('output%s' % numPass)
+        dstDir = self._getExtraPath('MicAssess')
+        for root, _, files in os.walk(srcDir):
+            dst = os.path.join(dstDir, os.path.relpath(root, srcDir))
+            makePath(dst)
+            for fn in files:
+                os.replace(os.path.join(root, fn), os.path.join(dst, fn))
 
     def initTotalStars(self):
         totalInputStarFn, totalOutputStar = self.getInputFilename(''), self.getOutputFilename('')
@@ -205,32 +260,37 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
         f1.write(sameTxt), f2.write(sameTxt)
         f1.close(), f2.close()
 
-    def appendTotalInputStar(self, numPass):
-        totalStarFn = self.getInputFilename('')
-        newMicNames = self._getInputMicFns(numPass)
-        if os.path.exists(totalStarFn):
-            with open(totalStarFn, 'a') as f:
-                for micName in newMicNames:
-                    f.write(' ' + micName + '\n')
-
-    def appendTotalOutputStar(self, numPass):
-        totalStarFn = self.getOutputFilename('')
-        newMicNames = self._getGoodMicFns(numPass)
-        if os.path.exists(totalStarFn):
-            with open(totalStarFn, 'a') as f:
-                for micName in newMicNames:
-                    f.write(' ' + micName + '\n')
-
-    def addDoneMicFns(self, newMics):
-        for newMic in newMics:
-            self.doneMicFns.add(newMic.getFileName())
+    def appendTotalInputStar(self, newMicNames):
+        self._appendToTotalStar(self.getInputFilename(''), newMicNames)
+
+    def appendTotalOutputStar(self, newMicNames):
+        self._appendToTotalStar(self.getOutputFilename(''), newMicNames)
+
+    def _appendToTotalStar(self, totalStarFn, newMicNames):
+        """ Append rows through a handle kept open across passes. """
+        with self._outputLock:
+            fh = self._starHandles.get(totalStarFn)
+            if fh is None:
+                if not os.path.exists(totalStarFn):
+                    return
+                fh = self._starHandles[totalStarFn] = open(totalStarFn, 'a')
+            fh.write(''.join(' ' + micName + '\n' for micName in newMicNames))
+            fh.flush()
+
+    def addDoneMics(self, newMics):
+        """ Advance the id cursor past the mics dispatched in this batch. """
+        self.lastMicId = max(mic.getObjId() for mic in newMics)
+        self._pendingMics = []
 
     def checkIfParentFinished(self):
-        inpMics = self._getInputMicrographs()
-        inpMics.loadAllProperties()
-        if not inpMics.isStreamOpen():
-            return True
-        return False
+        """ Once the input stream is closed it never reopens, so stop
+        reloading the set properties after that. """
+        if not self._parentFinished:
+            inpMics = self._getInputMicrographs()
+            inpMics.loadAllProperties()
+            if not inpMics.isStreamOpen():
+                self._parentFinished = True
+        return self._parentFinished
 
     def _getFirstJoinStepName(self):
         # This function will be used for streaming, to check which is
@@ -278,16 +338,31 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
         return args
 
     def _getInputMicrographs(self):
-        return self.inputMicrographs.get()
+        """ Dereference the input pointer only once; the cached set still
+        sees new items, as iterItems/loadAllProperties query the sqlite
+        file directly. """
+        if self._inputMicsCache is None:
+            self._inputMicsCache = self.inputMicrographs.get()
+        return self._inputMicsCache
 
     def _getNewInput(self):
+        """ Return mics not yet dispatched, querying only beyond the
+        last dispatched id instead of rescanning the whole set. Idle
+        polls are answered from the pending list without touching the
+        database, based on the sqlite file's mtime. """
         inputMics = self._getInputMicrographs()
-        newMics = []
-        for mic in inputMics:
-            if mic.getFileName() not in self.doneMicFns:
-                newMic = mic.clone()
-                newMics.append(newMic)
-        return newMics
+        try:
+            mTime = os.path.getmtime(inputMics.getFileName())
+        except OSError:
+            mTime = 0
+        if (mTime == self._lastMicsMTime and not self.lastRound
+                and not self._parentFinished):
+            return self._pendingMics
+
+        self._lastMicsMTime = mTime
+        self._pendingMics = [mic.clone() for mic in
+                             inputMics.iterItems(where='id>%d' % self.lastMicId)]
+        return self._pendingMics
 
     def getInputFilename(self, numPass):
         if numPass == '':
@@ -302,40 +377,68 @@ class CryoassessProtMics(ProtPreprocessMicrographs, Protocol):
             return self._getTmpPath('input_micrographs{}_good.star'.format(numPass))
 
     def _getCameraType(self):
-        """ Get camera type based on input mic size.
+        """ Get camera type based on input mic size, computed only once.
         :return string or None """
-        micsizeX, micsizeY, _ = self._getInputMicrographs().getDim()
-        x = max(micsizeX, micsizeY)
-        y = min(micsizeX, micsizeY)
-        if math.isclose(x / y, 1.0345, abs_tol=0.001):
-            return 'K2'
-        elif math.isclose(x / y, 1.4076, abs_tol=0.001):
-            return 'K3'
-        else:
-            return None
-
-    def _getInputMicFns(self, numPass):
-        """ Parse input star file and get a list of mics. """
-        table = Table(fileName=self.getInputFilename(numPass), tableName='')
-        micNames = table.getColumnValues('rlnMicrographName')
-        return micNames
+        if not self._cameraTypeDone:
+            micsizeX, micsizeY, _ = self._getInputMicrographs().getDim()
+            x = max(micsizeX, micsizeY)
+            y = min(micsizeX, micsizeY)
+            for refRatio, camera in self._RATIO_TABLE:
+                if abs(x / y - refRatio) <= 0.001:
+                    self._cameraType = camera
+                    break
+            self._cameraTypeDone = True
+
+        return self._cameraType
 
     def _getGoodMicFns(self, numPass):
-        """ Parse output star file and get a list of good mics. """
+        """ Parse output star file and get a list of good mics.
+        The file has a single rlnMicrographName column, so a plain
+        line scan is enough - no need for a full star parser. """
         micNames = []
-        if os.path.exists(self.getOutputFilename(numPass)):
-            table = Table(fileName=self.getOutputFilename(numPass), tableName='')
-            micNames = table.getColumnValues('rlnMicrographName')
+        outputFn = self.getOutputFilename(numPass)
+        if os.path.exists(outputFn):
+            with open(outputFn) as f:
+                for line in f:
+                    s = line.strip()
+                    if not s or s.startswith(('#', 'data_', 'loop_', '_')):
+                        continue
+                    micNames.append(s.split(None, 1)[0])
         return micNames
 
+    def _absPath(self, fn):
+        """ Absolute path without the getcwd syscall that os.path.abspath
+        pays on every call; cwd is fixed for the whole run. """
+        return fn if os.path.isabs(fn) else os.path.join(self._cwd, fn)
+
+    def _getGoodIds(self, newMics, goodMicNames):
+        """ Map the good filenames of one pass back to objIds. Mics that
+        were dropped from the star file as duplicates of another entry
+        inherit the verdict of their physical file via realpath. """
+        goodNames = set(goodMicNames)
+        goodReal = {os.path.realpath(n) for n in goodMicNames}
+        goodIds = set()
+        for mic in newMics:
+            oid = mic.getObjId()
+            fn = self._absByObjId.get(oid)
+            if fn is None:  # cache lost to a restart
+                fn = self._absPath(mic.getFileName())
+            if fn in goodNames:
+                goodIds.add(oid)
+            else:
+                real = self._realByObjId.get(oid) or os.path.realpath(fn)
+                if real in goodReal:
+                    goodIds.add(oid)
+        return goodIds
+
     def _addGoodMic(self, item, row):
         """ Callback function to append only good items. """
-        if os.path.abspath(item.getFileName()) not in self.curGoodList:
+        if item.getObjId() not in self._curGoodIds:
             setattr(item, "_appendItem", False)
 
     def _addBadMic(self, item, row):
         """ Callback function to append only bad items. """
-        if os.path.abspath(item.getFileName()) in self.curGoodList:
+        if item.getObjId() in self._curGoodIds:
             setattr(item, "_appendItem", False)
 
     # --------------------------- INFO functions ------------------------------